@@ -0,0 +1,150 @@
+# Startup import-time check of the tools.
+#
+# The check is meant to run before building the Docker images, e.g. as a CI
+# step or a pre-commit hook: it exits with a non-zero status if the main module
+# of a tool exceeds its import-time budget or imports a heavy module at startup.
+import argparse
+import os
+import subprocess
+import sys
+from typing import List, Tuple
+
+# Tool folders and the import-time budget of their main module in milliseconds
+IMPORT_TIME_BUDGETS_MS = {
+    "snr": 50,
+    "convolution_2d": 50,
+    "convolution_2d_xnat": 50,
+}
+
+# Modules that must only be imported on the code path that needs them
+LAZY_MODULES = ["cv2", "numpy", "pydicom", "requests", "xnat"]
+
+
+def measure_import_time(path_tool_folder: str) -> List[Tuple[str, int, int]]:
+    """
+    Import the main module of a tool with "-X importtime" and parse the report.
+
+    Parameters
+    ----------
+    path_tool_folder : str
+        Folder containing the main.py of the tool.
+
+    Returns
+    -------
+    List[Tuple[str, int, int]]
+        Module name, self time and cumulative time in microseconds, for each
+        imported module.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        cwd=path_tool_folder,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(
+            f"Importing '{path_tool_folder}/main.py' failed:\n{result.stderr}"
+        )
+
+    import_times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, module = line[len("import time:") :].split("|")
+        import_times.append((module.rstrip(), int(self_us), int(cumulative_us)))
+    return import_times
+
+
+def check_import_time(path_tool_folder: str, budget_ms: float, top: int) -> bool:
+    """
+    Check the import time of the main module of a tool against its budget,
+    and check that it does not import any of the lazy modules.
+
+    Parameters
+    ----------
+    path_tool_folder : str
+        Folder containing the main.py of the tool.
+    budget_ms : float
+        Import-time budget in milliseconds.
+    top : int
+        Number of slowest imports of main to print.
+
+    Returns
+    -------
+    bool
+        True if the tool is within budget and imports no lazy module.
+    """
+    tool = os.path.basename(path_tool_folder)
+    import_times = measure_import_time(path_tool_folder)
+
+    # The report lists the imports of a module before the module itself, and
+    # nests them by indentation. Only the "main" entry is budgeted, so that
+    # the interpreter startup (site, encodings, ...) is not counted.
+    main_imports = []
+    main_ms = None
+    subtree = []
+    for module, _, cumulative_us in import_times:
+        depth = (len(module) - len(module.lstrip())) // 2
+        if depth > 0:
+            subtree.append((depth, module.strip(), cumulative_us))
+            continue
+        if module.strip() == "main":
+            main_ms = cumulative_us / 1000
+            main_imports = [(name, us) for depth, name, us in subtree if depth == 1]
+        subtree = []
+
+    if main_ms is None:
+        raise RuntimeError(f"No 'main' entry in the import time report of {tool}.")
+
+    imported_modules = {module.strip() for module, _, _ in import_times}
+    eager_modules = [module for module in LAZY_MODULES if module in imported_modules]
+
+    within_budget = main_ms <= budget_ms
+    print(
+        f"{'OK  ' if within_budget else 'FAIL'} {tool}: "
+        f"main imported in {main_ms:.1f} ms (budget {budget_ms:.0f} ms)"
+    )
+    for module, cumulative_us in sorted(main_imports, key=lambda x: -x[1])[:top]:
+        print(f"       {cumulative_us / 1000:8.1f} ms  {module}")
+
+    print(
+        f"{'FAIL' if eager_modules else 'OK  '} {tool}: heavy modules imported at "
+        f"startup: {', '.join(eager_modules) if eager_modules else 'none'}"
+    )
+
+    return within_budget and not eager_modules
+
+
+def main():
+    """
+    Main function to check the startup import time of every tool.
+    """
+    parser = argparse.ArgumentParser(
+        description="Check the import time of the tools against a budget"
+    )
+    parser.add_argument(
+        "--budget-ms",
+        type=float,
+        default=None,
+        help="Override the import-time budget of every tool",
+    )
+    parser.add_argument(
+        "--top", type=int, default=5, help="Number of slowest imports to print"
+    )
+    args = parser.parse_args()
+
+    path_root = os.path.dirname(os.path.abspath(__file__))
+    all_passed = True
+    for tool, budget_ms in IMPORT_TIME_BUDGETS_MS.items():
+        passed = check_import_time(
+            os.path.join(path_root, tool),
+            args.budget_ms if args.budget_ms is not None else budget_ms,
+            args.top,
+        )
+        all_passed = all_passed and passed
+
+    sys.exit(0 if all_passed else 1)
+
+
+if __name__ == "__main__":
+    main()
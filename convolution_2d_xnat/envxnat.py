@@ -1,10 +1,7 @@
 #!/usr/bin/env python
+import os
 import sys
 import argparse
-import requests
-from requests.auth import HTTPBasicAuth
-import requests.packages.urllib3
-requests.packages.urllib3.disable_warnings()
 
 
 
@@ -40,11 +37,28 @@ def envvar():
     parser.add_argument('subjectLabel', help='Subject label')
     parser.add_argument('sessionId', help='Session id')
     parser.add_argument('project', help='Project')
-    parser.add_argument('xnat_host', help='XNAT Host')
-    parser.add_argument('xnat_user', help='XNAT Username')
-    parser.add_argument('xnat_pass', help='XNAT Password')
+    # Credentials can be passed in the environment so that they do not show up in the process list
+    parser.add_argument('xnat_host', nargs='?', default=os.environ.get('XNAT_HOST'),
+                        help='XNAT Host (default: $XNAT_HOST)')
+    parser.add_argument('xnat_user', nargs='?', default=os.environ.get('XNAT_USER'),
+                        help='XNAT Username (default: $XNAT_USER)')
+    parser.add_argument('xnat_pass', nargs='?', default=os.environ.get('XNAT_PASS'),
+                        help='XNAT Password (default: $XNAT_PASS)')
+    parser.add_argument('--jsession', default=os.environ.get('XNAT_JSESSION'),
+                        help='Existing XNAT JSESSIONID token to reuse instead of logging in (default: $XNAT_JSESSION)')
+    parser.add_argument('--max-uploads', type=int, default=4,
+                        help='Maximum number of scans uploaded concurrently')
     args=parser.parse_args()
 
+    if args.xnat_host is None:
+        parser.error('the XNAT host is required (argument or $XNAT_HOST)')
+    if args.max_uploads < 1:
+        parser.error('--max-uploads must be at least 1')
+
+    # Imported after parsing so that --version and --idstring exit without loading requests
+    import requests.packages.urllib3
+    requests.packages.urllib3.disable_warnings()
+
 
     subjectLabel = args.subjectLabel
     sessionId = args.sessionId
@@ -54,5 +68,7 @@ def envvar():
     xnat_host = args.xnat_host
     xnat_user = args.xnat_user
     xnat_pass = args.xnat_pass
+    xnat_jsession = args.jsession
+    max_uploads = args.max_uploads
     
-    return project, subjectLabel, sessionId, xnat_host, xnat_user, xnat_pass
+    return project, subjectLabel, sessionId, xnat_host, xnat_user, xnat_pass, xnat_jsession, max_uploads
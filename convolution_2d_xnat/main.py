@@ -1,24 +1,119 @@
+from __future__ import annotations
+
+import hashlib
 import os
 import shutil
+import tempfile
+import threading
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from io import BytesIO
+from typing import TYPE_CHECKING, Any, Dict, Iterable, List, Optional, Set, Tuple
+from xml.etree import ElementTree
+
+if TYPE_CHECKING:
+    import numpy as np
+    import pydicom
+    import requests
+    import xnat.session
 
-from typing import List, Tuple
+from envxnat import envvar
 
-import cv2
-import numpy as np
-import pydicom
-import xnat
 
-from envxnat import envvar
+# A DICOM Part 10 file starts with a 128-byte preamble followed by "DICM"
+DICOM_PREAMBLE_LENGTH = 128
+DICOM_MAGIC = b"DICM"
+# Number of bytes read from each file to parse the series tags
+DICOM_HEADER_READ_SIZE = 8192
+SERIES_TAGS = ["SeriesInstanceUID", "SeriesNumber", "SeriesDescription"]
+
+# XNAT catalogs list the MD5 digest of each file of a resource
+CATALOG_SUFFIX = "catalog.xml"
+CATALOG_ENTRY_TAG = "{http://nrg.wustl.edu/catalog}entry"
+
+# Values of the VERIFY_DIGESTS and ON_DIGEST_MISMATCH environment variables
+DIGEST_MISMATCH_ACTIONS = ("fail", "quarantine")
+BOOLEAN_VALUES = {
+    "1": True,
+    "true": True,
+    "yes": True,
+    "0": False,
+    "false": False,
+    "no": False,
+}
+
+
+def is_dicom_file(path_file: str) -> bool:
+    """
+    Check whether a file is a DICOM file from its preamble and "DICM" magic.
+
+    Parameters
+    ----------
+    path_file : str
+        Path to the file.
+
+    Returns
+    -------
+    bool
+        True if the file is a DICOM file, False otherwise.
+    """
+    try:
+        with open(path_file, "rb") as file:
+            header = file.read(DICOM_PREAMBLE_LENGTH + len(DICOM_MAGIC))
+    except OSError:
+        return False
+    return header[DICOM_PREAMBLE_LENGTH:] == DICOM_MAGIC
+
+
+def _scan_folder(
+    path_folder: str, excluded_folders: Set[str]
+) -> Tuple[List[str], List[str]]:
+    """
+    List the files and the subfolders of a single folder.
 
+    Parameters
+    ----------
+    path_folder : str
+        Path to the folder.
+    excluded_folders : Set[str]
+        Real paths of the subfolders to skip.
 
-def get_dicom_files(path_input_folder: str) -> List[str]:
+    Returns
+    -------
+    Tuple[List[str], List[str]]
+        File paths and subfolder paths.
+    """
+    files = []
+    subfolders = []
+    with os.scandir(path_folder) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if os.path.realpath(entry.path) not in excluded_folders:
+                    subfolders.append(entry.path)
+            elif entry.is_file():
+                files.append(os.path.normpath(entry.path))
+    return files, subfolders
+
+
+def get_dicom_files(
+    path_input_folder: str,
+    excluded_folders: Iterable[str] = (),
+    max_workers: Optional[int] = None,
+) -> List[str]:
     """
     Find all DICOM files in the given folder.
 
+    Folders are scanned and files are checked for the DICOM magic concurrently,
+    so that the latency of network-mounted folders overlaps. Files are
+    recognised by their content, not by their extension.
+
     Parameters
     ----------
     path_input_folder : str
         Path to the directory containing DICOM files.
+    excluded_folders : Iterable[str]
+        Subfolders to skip, e.g. an output folder inside the input folder.
+    max_workers : Optional[int]
+        Maximum number of threads. Defaults to the ThreadPoolExecutor default.
 
     Returns
     -------
@@ -28,77 +123,282 @@ def get_dicom_files(path_input_folder: str) -> List[str]:
     if not os.path.exists(path_input_folder):
         raise FileNotFoundError(f"Folder '{path_input_folder}' does not exist.")
 
-    dicom_files = [
-        os.path.normpath(os.path.join(root, file))
-        for root, _, files in os.walk(path_input_folder)
-        for file in files
-        if file.lower().endswith(".dcm") and "_denoised" not in file.lower()
-    ]
+    excluded_real_paths = {os.path.realpath(folder) for folder in excluded_folders}
+    candidate_files = []
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {
+            executor.submit(_scan_folder, path_input_folder, excluded_real_paths)
+        }
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, subfolders = future.result()
+                candidate_files.extend(files)
+                pending.update(
+                    executor.submit(_scan_folder, subfolder, excluded_real_paths)
+                    for subfolder in subfolders
+                )
+
+        candidate_files.sort()
+        dicom_files = [
+            path
+            for path, is_dicom in zip(
+                candidate_files, executor.map(is_dicom_file, candidate_files)
+            )
+            if is_dicom
+        ]
 
     if not dicom_files:
-        raise FileNotFoundError(
-            f"No DICOM files (.dcm) found in '{path_input_folder}'."
-        )
+        raise FileNotFoundError(f"No DICOM files found in '{path_input_folder}'.")
     return dicom_files
 
 
-def check_order_dicom(list_input_dicom: List[str]) -> List[str]:
+def read_dicom_header(path_file: str) -> pydicom.Dataset:
+    """
+    Read the series tags of a DICOM file from the first bytes of the file.
+
+    Parameters
+    ----------
+    path_file : str
+        Path to the DICOM file.
+
+    Returns
+    -------
+    pydicom.Dataset
+        Dataset containing only the series tags.
+    """
+    import pydicom
+
+    with open(path_file, "rb") as file:
+        header = file.read(DICOM_HEADER_READ_SIZE)
+
+    try:
+        ds = pydicom.dcmread(
+            BytesIO(header), stop_before_pixels=True, specific_tags=SERIES_TAGS
+        )
+    except Exception:
+        ds = None
+
+    # Header longer than the bytes read: parse the file up to the pixel data
+    if ds is None or "SeriesInstanceUID" not in ds:
+        ds = pydicom.dcmread(
+            path_file, stop_before_pixels=True, specific_tags=SERIES_TAGS
+        )
+    return ds
+
+
+def group_dicom_by_series(
+    list_input_dicom: List[str],
+    excluded_description_suffix: Optional[str] = None,
+    max_workers: Optional[int] = None,
+) -> Dict[str, List[str]]:
+    """
+    Group DICOM files by Series Instance UID.
+
+    Parameters
+    ----------
+    list_input_dicom : List[str]
+        List of DICOM file paths.
+    excluded_description_suffix : Optional[str]
+        Skip the series whose Series Description ends with this suffix.
+    max_workers : Optional[int]
+        Maximum number of threads. Defaults to the ThreadPoolExecutor default.
+
+    Returns
+    -------
+    Dict[str, List[str]]
+        DICOM file paths for each Series Instance UID.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        headers = list(executor.map(read_dicom_header, list_input_dicom))
+
+    dicom_series: Dict[str, List[str]] = {}
+    for path, ds in zip(list_input_dicom, headers):
+        series_instance_uid = getattr(ds, "SeriesInstanceUID", None)
+        if series_instance_uid is None:
+            raise ValueError(f"Missing SeriesInstanceUID in DICOM file {path}")
+
+        series_description = str(getattr(ds, "SeriesDescription", ""))
+        if excluded_description_suffix and series_description.upper().endswith(
+            excluded_description_suffix
+        ):
+            continue
+
+        dicom_series.setdefault(str(series_instance_uid), []).append(path)
+    return dicom_series
+
+
+def get_catalog_digests(list_input_dicom: List[str]) -> Dict[str, str]:
+    """
+    Read the MD5 digests listed in the XNAT catalogs next to the DICOM files.
+
+    Parameters
+    ----------
+    list_input_dicom : List[str]
+        List of DICOM file paths.
+
+    Returns
+    -------
+    Dict[str, str]
+        MD5 digest for each file path listed in a catalog.
+    """
+    catalog_digests = {}
+    for path_folder in sorted({os.path.dirname(path) for path in list_input_dicom}):
+        with os.scandir(path_folder or ".") as entries:
+            catalog_paths = [
+                entry.path
+                for entry in entries
+                if entry.is_file() and entry.name.endswith(CATALOG_SUFFIX)
+            ]
+
+        for catalog_path in catalog_paths:
+            try:
+                catalog = ElementTree.parse(catalog_path)
+            except (ElementTree.ParseError, OSError) as e:
+                print(f"Warning: ignoring unreadable catalog '{catalog_path}': {e}")
+                continue
+
+            for entry in catalog.iter(CATALOG_ENTRY_TAG):
+                uri = entry.get("URI")
+                digest = entry.get("digest")
+                if uri and digest:
+                    path = os.path.normpath(os.path.join(path_folder, uri))
+                    catalog_digests[path] = digest.lower()
+    return catalog_digests
+
+
+def _read_dicom_slice(
+    path_file: str, expected_digest: Optional[str]
+) -> Tuple[bool, Optional[Tuple[Any, Tuple[int, ...], Any]]]:
+    """
+    Read a DICOM file once, verifying its MD5 digest and parsing the same bytes.
+
+    Parameters
+    ----------
+    path_file : str
+        Path to the DICOM file.
+    expected_digest : Optional[str]
+        Expected MD5 digest. If None, the file is not verified.
+
+    Returns
+    -------
+    Tuple[bool, Optional[Tuple[Any, Tuple[int, ...], Any]]]
+        Whether the digest matches, and the Instance Number, shape and data
+        type of the slice (None if the digest does not match).
+    """
+    import numpy as np
+    import pydicom
+
+    with open(path_file, "rb") as file:
+        data = file.read()
+
+    if expected_digest is not None:
+        digest = hashlib.md5(data, usedforsecurity=False).hexdigest()
+        if digest != expected_digest:
+            return False, None
+
+    ds = pydicom.dcmread(BytesIO(data))
+
+    instance_number = getattr(ds, "InstanceNumber", None)
+    if instance_number is None:
+        raise ValueError(f"Missing InstanceNumber in DICOM file {path_file}")
+
+    if not isinstance(ds.pixel_array, np.ndarray):
+        raise TypeError(
+            f"Invalid image format. Expected a NumPy array. DICOM file {path_file}."
+        )
+
+    if len(ds.pixel_array.shape) != 2:
+        raise ValueError(f"DICOM file {path_file} is not a 2D slice.")
+
+    return True, (instance_number, ds.pixel_array.shape, ds.pixel_array.dtype)
+
+
+def check_order_dicom(
+    list_input_dicom: List[str],
+    catalog_digests: Optional[Dict[str, str]] = None,
+    on_digest_mismatch: str = "fail",
+    max_workers: Optional[int] = None,
+) -> List[str]:
     """
     Check that all DICOM images in the input folder have valid and unique Instance Number,
     slices are 2D and have the same dimensions, data type and valid images.
     Reorder the DICOM file paths based on the Instance Number.
 
+    Files are read in a thread pool. If catalog digests are given, each file is
+    hashed from the same bytes that are parsed, so the verification does not
+    add a read.
+
     Parameters
     ----------
     list_input_dicom : List[str]
         List of DICOM file paths.
+    catalog_digests : Optional[Dict[str, str]]
+        Expected MD5 digest for each file path. Files without a digest are not verified.
+    on_digest_mismatch : str
+        "fail" to raise an error on a digest mismatch, "quarantine" to leave the
+        corrupted slices out of the returned list.
+    max_workers : Optional[int]
+        Maximum number of threads. Defaults to the ThreadPoolExecutor default.
 
     Returns
     -------
     List[str]
         List of DICOM file paths sorted by Instance Number.
     """
+    if on_digest_mismatch not in DIGEST_MISMATCH_ACTIONS:
+        raise ValueError(
+            f"Invalid on_digest_mismatch '{on_digest_mismatch}'. "
+            "Expected 'fail' or 'quarantine'."
+        )
+    catalog_digests = catalog_digests or {}
+
     dicom_with_instances = []
     instance_numbers_set = set()
     reference_shape = None
     reference_dtype = None
 
-    for path in list_input_dicom:
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        slices = executor.map(
+            _read_dicom_slice,
+            list_input_dicom,
+            [catalog_digests.get(path) for path in list_input_dicom],
+        )
 
-        ds = pydicom.dcmread(path)
+        for path, (digest_ok, slice_info) in zip(list_input_dicom, slices):
 
-        instance_number = getattr(ds, "InstanceNumber", None)
-        if instance_number is None:
-            raise ValueError(f"Missing InstanceNumber in DICOM file {path}")
+            if not digest_ok:
+                if on_digest_mismatch == "fail":
+                    raise ValueError(f"MD5 digest mismatch in DICOM file {path}")
+                print(f"Quarantined DICOM file {path}: MD5 digest mismatch.")
+                continue
 
-        if instance_number in instance_numbers_set:
-            raise ValueError(
-                f"Duplicate Instance Number detected: {instance_number} in DICOM file {path}"
-            )
-        instance_numbers_set.add(instance_number)
+            instance_number, shape, dtype = slice_info
 
-        if not isinstance(ds.pixel_array, np.ndarray):
-            raise TypeError(
-                f"Invalid image format. Expected a NumPy array. DICOM file {path}."
-            )
+            if instance_number in instance_numbers_set:
+                raise ValueError(
+                    f"Duplicate Instance Number detected: {instance_number} in DICOM file {path}"
+                )
+            instance_numbers_set.add(instance_number)
 
-        if len(ds.pixel_array.shape) != 2:
-            raise ValueError(f"DICOM file {path} is not a 2D slice.")
+            if reference_shape is None:
+                reference_shape = shape
+            elif shape != reference_shape:
+                raise ValueError(
+                    f"Inconsistent slice dimensions detected in DICOM file {path}."
+                )
 
-        if reference_shape is None:
-            reference_shape = ds.pixel_array.shape
-        elif ds.pixel_array.shape != reference_shape:
-            raise ValueError(
-                f"Inconsistent slice dimensions detected in DICOM file {path}."
-            )
+            if reference_dtype is None:
+                reference_dtype = dtype
+            elif dtype != reference_dtype:
+                raise ValueError(
+                    f"Inconsistent slice data type detected in DICOM file {path}."
+                )
+            dicom_with_instances.append((instance_number, path))
 
-        if reference_dtype is None:
-            reference_dtype = ds.pixel_array.dtype
-        elif ds.pixel_array.dtype != reference_dtype:
-            raise ValueError(
-                f"Inconsistent slice data type detected in DICOM file {path}."
-            )
-        dicom_with_instances.append((instance_number, path))
+    if not dicom_with_instances:
+        raise ValueError("All DICOM files were quarantined.")
 
     # Sort files by Instance Number
     dicom_with_instances.sort(key=lambda x: x[0])
@@ -128,6 +428,9 @@ def convolution_2d(
     path_output_folder: str
          Folder where to save the DICOM files
     """
+    import cv2
+    import pydicom
+
     dicom_meta = pydicom.dcmread(list_input_dicom_sorted[0])
     elem_2 = dicom_meta.SeriesInstanceUID
     index_last_2 = elem_2.rfind(".")
@@ -169,69 +472,368 @@ def convolution_2d(
         dico.PixelData = den_max.tobytes()
 
         # Construct the new file name for the denoised DICOM file
-        name_denoised = os.path.basename(path_dicom).replace(".dcm", "_denoised.dcm")
+        # Extensionless names (e.g. UIDs) keep their dots and get ".dcm" appended
+        name_dicom = os.path.basename(path_dicom)
+        if name_dicom.lower().endswith(".dcm"):
+            name_dicom = name_dicom[: -len(".dcm")]
+        name_denoised = f"{name_dicom}_denoised.dcm"
         new_path = os.path.join(path_output_folder, name_denoised)
         dico.save_as(new_path)
 
 
+def connect_xnat(
+    xnat_host: str,
+    xnat_user: Optional[str] = None,
+    xnat_pass: Optional[str] = None,
+    xnat_jsession: Optional[str] = None,
+) -> xnat.session.BaseXNATSession:
+    """
+    Connect to XNAT, reusing an existing JSESSIONID token when one is given.
+
+    The data model is not parsed, as only the REST API is used. A session opened
+    from a given token is not logged out on disconnect, so the token stays valid
+    for its owner: this relies on cli=True, which selects the session class that
+    does not log out.
+
+    Parameters
+    ----------
+    xnat_host : str
+        XNAT host.
+    xnat_user : Optional[str]
+        XNAT username.
+    xnat_pass : Optional[str]
+        XNAT password.
+    xnat_jsession : Optional[str]
+        Existing JSESSIONID token.
+
+    Returns
+    -------
+    xnat.session.BaseXNATSession
+        Authenticated XNAT connection.
+    """
+    import xnat
+
+    if xnat_jsession:
+        try:
+            # cli=True is what keeps the token of the caller valid: it makes
+            # xnat.connect return a BaseXNATSession, whose disconnect() does not
+            # log out (DELETE /data/JSESSION), unlike the default XNATSession
+            return xnat.connect(
+                xnat_host, jsession=xnat_jsession, no_parse_model=True, cli=True
+            )
+        except Exception as e:
+            if xnat_pass is None:
+                raise
+            print(f"JSESSION token rejected ({e}), logging in with the password.")
+
+    return xnat.connect(
+        xnat_host, user=xnat_user, password=xnat_pass, no_parse_model=True
+    )
+
+
+def get_experiment_label(
+    connection: xnat.session.BaseXNATSession, project: str, session_id: str
+) -> str:
+    """
+    Get the label of an XNAT experiment.
+
+    Parameters
+    ----------
+    connection : xnat.session.BaseXNATSession
+        Authenticated XNAT connection.
+    project : str
+        XNAT project.
+    session_id : str
+        XNAT experiment ID or label.
+
+    Returns
+    -------
+    str
+        Experiment label.
+    """
+    experiment = connection.get_json(
+        f"/data/projects/{project}/experiments/{session_id}"
+    )
+    return experiment["items"][0]["data_fields"]["label"]
+
+
+class ScanUploader:
+    """
+    Upload zip archives of scans to an XNAT experiment, at most max_uploads at once.
+
+    A requests.Session is not guaranteed to be thread-safe, so each worker thread
+    uses its own HTTP session instead of the one of the connection. The worker
+    sessions copy the authentication of the connection (its JSESSIONID), so no
+    upload logs in again, and each one keeps its HTTP connection alive across
+    the uploads of its worker.
+
+    Parameters
+    ----------
+    connection : xnat.session.BaseXNATSession
+        Authenticated XNAT connection.
+    xnat_host : str
+        XNAT host.
+    max_uploads : int
+        Maximum number of concurrent uploads.
+    """
+
+    def __init__(
+        self,
+        connection: xnat.session.BaseXNATSession,
+        xnat_host: str,
+        max_uploads: int,
+    ) -> None:
+        self._import_url = f"{xnat_host.rstrip('/')}/data/services/import"
+        self._auth = connection.interface.auth
+        self._cookies = connection.interface.cookies.copy()
+        self._verify = connection.interface.verify
+        # The raw uploads use the timeout of the xnatpy requests, so that a
+        # stalled server fails the upload instead of blocking the worker
+        self._timeout = connection.request_timeout
+        self._local = threading.local()
+        self._sessions: List[requests.Session] = []
+        self._sessions_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_uploads)
+        self._futures: List[Future] = []
+
+    def __enter__(self) -> ScanUploader:
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def _get_session(self) -> requests.Session:
+        """
+        Get the HTTP session of the current worker thread, creating it on first use.
+        """
+        import requests
+
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = requests.Session()
+            session.auth = self._auth
+            session.cookies.update(self._cookies)
+            session.verify = self._verify
+            self._local.session = session
+            with self._sessions_lock:
+                self._sessions.append(session)
+        return session
+
+    def _upload(self, path_archive: str, query: Dict[str, str]) -> None:
+        """
+        Upload a zip archive with the session of the current worker thread.
+        """
+        with open(path_archive, "rb") as file:
+            response = self._get_session().post(
+                self._import_url,
+                params=query,
+                data=file,
+                headers={"Content-Type": "application/zip"},
+                timeout=self._timeout,
+            )
+        if response.status_code != 200:
+            raise RuntimeError(
+                f"Upload of '{path_archive}' failed with status "
+                f"{response.status_code}: {response.text}"
+            )
+        print(f"'{path_archive}' uploaded successfully.")
+
+    def submit(
+        self,
+        path_archive: str,
+        project: str,
+        subject_label: str,
+        experiment_label: str,
+    ) -> None:
+        """
+        Queue the upload of a zip archive of DICOM files to an XNAT experiment.
+
+        Parameters
+        ----------
+        path_archive : str
+            Path to the zip archive.
+        project : str
+            XNAT project.
+        subject_label : str
+            XNAT subject label.
+        experiment_label : str
+            XNAT experiment label.
+        """
+        query = {
+            # Each scan is a separate import into the same session: "delete"
+            # would replace the scans uploaded before it
+            "overwrite": "append",
+            "project": project,
+            "subject": subject_label,
+            "session": experiment_label,
+        }
+        self._futures.append(self._executor.submit(self._upload, path_archive, query))
+
+    def wait(self) -> None:
+        """
+        Wait for all the queued uploads, raising the first error.
+        """
+        for future in self._futures:
+            future.result()
+
+    def close(self) -> None:
+        """
+        Wait for the running uploads and close the worker sessions.
+        """
+        self._executor.shutdown(wait=True)
+        with self._sessions_lock:
+            for session in self._sessions:
+                session.close()
+            self._sessions.clear()
+
+
+def get_digest_settings() -> Tuple[bool, str]:
+    """
+    Read the MD5 digest verification settings from the environment.
+
+    The VERIFY_DIGESTS variable (default "true") enables the verification, and
+    the ON_DIGEST_MISMATCH variable (default "fail") sets what to do with a
+    corrupted file: "fail" or "quarantine".
+
+    Returns
+    -------
+    Tuple[bool, str]
+        Whether to verify the digests, and the action on a digest mismatch.
+    """
+    verify_digests = os.environ.get("VERIFY_DIGESTS", "true").strip().lower()
+    if verify_digests not in BOOLEAN_VALUES:
+        raise ValueError(
+            f"Invalid VERIFY_DIGESTS '{verify_digests}'. "
+            f"Expected one of {sorted(BOOLEAN_VALUES)}."
+        )
+
+    on_digest_mismatch = os.environ.get("ON_DIGEST_MISMATCH", "fail").strip().lower()
+    if on_digest_mismatch not in DIGEST_MISMATCH_ACTIONS:
+        raise ValueError(
+            f"Invalid ON_DIGEST_MISMATCH '{on_digest_mismatch}'. "
+            "Expected 'fail' or 'quarantine'."
+        )
+
+    return BOOLEAN_VALUES[verify_digests], on_digest_mismatch
+
+
 def main():
     """
     Main function to process DICOM files, generate a 3D image, and 2D Convolution.
     """
+    # Parse the arguments first, so that --version and --idstring return
+    # without loading the image processing modules
+    (
+        project,
+        subjectLabel,
+        sessionId,
+        xnat_host,
+        xnat_user,
+        xnat_pass,
+        xnat_jsession,
+        max_uploads,
+    ) = envvar()
+
     path_input_folder = "./input"
     path_output_folder = "./output"
 
     try:
+        verify_digests, on_digest_mismatch = get_digest_settings()
+
         # Get a list of dicom files contained in XNAT input folder
-        list_input_dicom = get_dicom_files(path_input_folder)
+        list_input_dicom = get_dicom_files(
+            path_input_folder, excluded_folders=[path_output_folder]
+        )
         print(
             f"Found {len(list_input_dicom)} DICOM files in '{path_input_folder}':\n"
             + "\n".join(f"'{file}'" for file in list_input_dicom)
         )
 
-        # Verify that the DICOM files in the XNAT input folder are valid
-        # and reorder them based on the Instance Number.
-        list_input_dicom_sorted = check_order_dicom(list_input_dicom)
-        print(
-            "DICOM files sorted by InstanceNumber:\n"
-            + "\n".join(f"'{file}'" for file in list_input_dicom_sorted)
-        )
+        # Import the image modules only once the input has been found
+        import numpy as np
+        import pydicom
 
-        # 2D Convolution (Image Filtering)
-        ref_ds = pydicom.dcmread(list_input_dicom_sorted[0])
-        num_rows, num_columns = ref_ds.pixel_array.shape
-        num_slices = len(list_input_dicom_sorted)
-        vol_dims = (num_slices, num_rows, num_columns)
-        vol_dtype = ref_ds.pixel_array.dtype
-
-        kernel = np.ones((5, 5), vol_dtype) / 25
+        # Read the expected MD5 digests, checked while the files are read
+        catalog_digests = (
+            get_catalog_digests(list_input_dicom) if verify_digests else {}
+        )
+        print(f"Found {len(catalog_digests)} catalog digests.")
 
-        convolution_2d(
-            list_input_dicom_sorted, vol_dims, vol_dtype, kernel, path_output_folder
+        # Group the DICOM files by series, skipping already denoised series
+        dicom_series = group_dicom_by_series(
+            list_input_dicom, excluded_description_suffix="_DENOISED"
         )
-        print("2D Convolution completed successfully!")
+        print(f"Found {len(dicom_series)} series in '{path_input_folder}'.")
 
-        # Upload dicom files to XNAT
-        project, subjectLabel, sessionId, xnat_host, xnat_user, xnat_pass = envvar()
+        # Connect to XNAT once, the login is shared by all the uploads
         print(
             f"Project: {project}, Subject Label: {subjectLabel}, Session ID: {sessionId}, "
-            f"XNAT Host: {xnat_host}, User: {xnat_user}, Password: {xnat_pass}"
+            f"XNAT Host: {xnat_host}, User: {xnat_user}"
         )
-        connection = xnat.connect(xnat_host, user=xnat_user, password=xnat_pass)
-        resource = connection.projects[project].experiments[sessionId]
-        Newexperiment = resource.label
-
-        archived = shutil.make_archive("Denoised.zip", "zip", path_output_folder)
-        connection.services.import_(
-            archived,
-            overwrite="delete",  # Overwrite parameter is important!
-            project=project,
-            subject=subjectLabel,
-            experiment=Newexperiment,
-            content_type="application/zip",
-        )
-
-        connection.disconnect()
+        connection = connect_xnat(xnat_host, xnat_user, xnat_pass, xnat_jsession)
+
+        try:
+            Newexperiment = get_experiment_label(connection, project, sessionId)
+
+            # Each scan is uploaded while the following ones are being processed.
+            # The archives are written outside the output folder.
+            with tempfile.TemporaryDirectory() as path_archive_folder, ScanUploader(
+                connection, xnat_host, max_uploads
+            ) as uploader:
+
+                for series_instance_uid, list_series_dicom in dicom_series.items():
+
+                    # Verify that the DICOM files in the XNAT input folder are intact
+                    # and valid, and reorder them based on the Instance Number.
+                    list_input_dicom_sorted = check_order_dicom(
+                        list_series_dicom, catalog_digests, on_digest_mismatch
+                    )
+                    print(
+                        "DICOM files sorted by InstanceNumber:\n"
+                        + "\n".join(f"'{file}'" for file in list_input_dicom_sorted)
+                    )
+
+                    # 2D Convolution (Image Filtering)
+                    ref_ds = pydicom.dcmread(list_input_dicom_sorted[0])
+                    num_rows, num_columns = ref_ds.pixel_array.shape
+                    num_slices = len(list_input_dicom_sorted)
+                    vol_dims = (num_slices, num_rows, num_columns)
+                    vol_dtype = ref_ds.pixel_array.dtype
+
+                    kernel = np.ones((5, 5), vol_dtype) / 25
+
+                    # One empty output folder per series, so that no file of
+                    # another series or of a previous run ends up in the upload
+                    path_series_output_folder = os.path.join(
+                        path_output_folder, series_instance_uid
+                    )
+                    shutil.rmtree(path_series_output_folder, ignore_errors=True)
+                    os.makedirs(path_series_output_folder)
+
+                    convolution_2d(
+                        list_input_dicom_sorted,
+                        vol_dims,
+                        vol_dtype,
+                        kernel,
+                        path_series_output_folder,
+                    )
+                    print(
+                        f"2D Convolution of series {series_instance_uid} "
+                        "completed successfully!"
+                    )
+
+                    # Upload dicom files to XNAT
+                    archived = shutil.make_archive(
+                        os.path.join(path_archive_folder, series_instance_uid),
+                        "zip",
+                        path_series_output_folder,
+                    )
+                    uploader.submit(archived, project, subjectLabel, Newexperiment)
+
+                uploader.wait()
+
+        finally:
+            connection.disconnect()
 
     except Exception as e:
         print(f"Error: {e}")
@@ -0,0 +1,244 @@
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import requests
+from main import ScanUploader, connect_xnat, get_experiment_label
+
+XNAT_USER = "user"
+XNAT_PASS = "pass"
+UPLOAD_DELAY = 0.2
+
+
+class StandInXNAT(ThreadingHTTPServer):
+    """
+    Local stand-in for the parts of the XNAT REST API used by the tool.
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StandInXNATHandler)
+        self.lock = threading.Lock()
+        self.valid_tokens = set()
+        self.logins = 0
+        self.logouts = 0
+        self.imports = []
+        self.uploads_in_flight = 0
+        self.stall_uploads = False
+        self.release_uploads = threading.Event()
+        self.max_uploads_in_flight = 0
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def new_token(self):
+        with self.lock:
+            token = f"{len(self.valid_tokens):032X}"
+            self.valid_tokens.add(token)
+            return token
+
+
+class StandInXNATHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def _token(self):
+        cookie = self.headers.get("Cookie", "")
+        for item in cookie.split(";"):
+            name, _, value = item.strip().partition("=")
+            if name == "JSESSIONID" and value in self.server.valid_tokens:
+                return value
+        return None
+
+    def _reply(self, status, body="", content_type="text/plain", token=None):
+        data = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        if token is not None:
+            self.send_header("Set-Cookie", f"JSESSIONID={token}; Path=/")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/":
+            self._reply(200, "<html>XNAT</html>", "text/html")
+        elif path == "/data/auth":
+            if self._token() is None:
+                self._reply(401, "Unauthorized")
+            else:
+                self._reply(200, f"User '{XNAT_USER}' is logged in")
+        elif path == "/data/JSESSION":
+            self._reply(200, self._token() or "")
+        elif path == "/data/projects/P1/experiments/S1":
+            if self._token() is None:
+                self._reply(401, "Unauthorized")
+            else:
+                items = {"items": [{"data_fields": {"ID": "S1", "label": "LABEL1"}}]}
+                self._reply(200, json.dumps(items), "application/json")
+        else:
+            self._reply(404, "Not found")
+
+    def do_PUT(self):
+        path = urlparse(self.path).path
+        length = int(self.headers.get("Content-Length", 0))
+        form = parse_qs(self.rfile.read(length).decode())
+        if path != "/data/services/auth":
+            self._reply(404, "Not found")
+        elif form.get("username") == [XNAT_USER] and form.get("password") == [
+            XNAT_PASS
+        ]:
+            with self.server.lock:
+                self.server.logins += 1
+            token = self.server.new_token()
+            self._reply(200, token, token=token)
+        else:
+            self._reply(401, "<h3>Login attempt failed</h3>")
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        if url.path != "/data/services/import":
+            self._reply(404, "Not found")
+            return
+        if self._token() is None:
+            self._reply(401, "Unauthorized")
+            return
+
+        if self.server.stall_uploads:
+            # Never reply, until the test is over
+            self.server.release_uploads.wait()
+            return
+
+        with self.server.lock:
+            self.server.uploads_in_flight += 1
+            self.server.max_uploads_in_flight = max(
+                self.server.max_uploads_in_flight, self.server.uploads_in_flight
+            )
+        time.sleep(UPLOAD_DELAY)
+        with self.server.lock:
+            self.server.uploads_in_flight -= 1
+            self.server.imports.append(parse_qs(url.query))
+        self._reply(200, "/data/prearchive/projects/P1/20240101_000000/LABEL1")
+
+    def do_DELETE(self):
+        if urlparse(self.path).path == "/data/JSESSION":
+            with self.server.lock:
+                self.server.logouts += 1
+                self.server.valid_tokens.discard(self._token())
+            self._reply(200)
+        else:
+            self._reply(404, "Not found")
+
+
+class TestXNATUpload(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StandInXNAT()
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.start()
+
+        self.archive_folder = tempfile.TemporaryDirectory()
+        self.archives = []
+        for i_archive in range(6):
+            path_archive = os.path.join(self.archive_folder.name, f"{i_archive}.zip")
+            with open(path_archive, "wb") as file:
+                file.write(os.urandom(1024))
+            self.archives.append(path_archive)
+
+    def tearDown(self):
+        self.server.release_uploads.set()
+        self.server.shutdown()
+        self.server.server_close()
+        self.server_thread.join()
+        self.archive_folder.cleanup()
+
+    def _upload_all(self, connection, max_uploads):
+        label = get_experiment_label(connection, "P1", "S1")
+        with ScanUploader(connection, self.server.url, max_uploads) as uploader:
+            for path_archive in self.archives:
+                uploader.submit(path_archive, "P1", "SUBJ1", label)
+            uploader.wait()
+
+    def test_single_login_per_run(self):
+        connection = connect_xnat(self.server.url, XNAT_USER, XNAT_PASS)
+        try:
+            self._upload_all(connection, max_uploads=3)
+        finally:
+            connection.disconnect()
+
+        self.assertEqual(self.server.logins, 1)
+        self.assertEqual(len(self.server.imports), len(self.archives))
+        for query in self.server.imports:
+            self.assertEqual(query["overwrite"], ["append"])
+            self.assertEqual(query["session"], ["LABEL1"])
+        self.assertEqual(self.server.logouts, 1)
+
+    def test_jsession_reuse(self):
+        token = self.server.new_token()
+        connection = connect_xnat(self.server.url, XNAT_USER, None, token)
+        try:
+            self._upload_all(connection, max_uploads=3)
+        finally:
+            connection.disconnect()
+
+        self.assertEqual(self.server.logins, 0)
+        self.assertEqual(len(self.server.imports), len(self.archives))
+        # The token of the caller is not logged out
+        self.assertEqual(self.server.logouts, 0)
+        self.assertIn(token, self.server.valid_tokens)
+
+    def test_jsession_rejected_falls_back_to_login(self):
+        connection = connect_xnat(self.server.url, XNAT_USER, XNAT_PASS, "EXPIRED")
+        try:
+            self._upload_all(connection, max_uploads=3)
+        finally:
+            connection.disconnect()
+
+        self.assertEqual(self.server.logins, 1)
+        self.assertEqual(len(self.server.imports), len(self.archives))
+
+    def test_jsession_rejected_without_password(self):
+        with self.assertRaises(Exception):
+            connect_xnat(self.server.url, XNAT_USER, None, "EXPIRED")
+        self.assertEqual(self.server.logins, 0)
+
+    def test_max_uploads_in_flight(self):
+        max_uploads = 2
+        connection = connect_xnat(self.server.url, XNAT_USER, XNAT_PASS)
+        try:
+            self._upload_all(connection, max_uploads=max_uploads)
+        finally:
+            connection.disconnect()
+
+        self.assertEqual(len(self.server.imports), len(self.archives))
+        self.assertLessEqual(self.server.max_uploads_in_flight, max_uploads)
+        self.assertGreater(self.server.max_uploads_in_flight, 1)
+
+    def test_stalled_upload_times_out(self):
+        self.server.stall_uploads = True
+        connection = connect_xnat(self.server.url, XNAT_USER, XNAT_PASS)
+        connection.request_timeout = 1
+        start = time.monotonic()
+        try:
+            with self.assertRaises(requests.exceptions.Timeout):
+                self._upload_all(connection, max_uploads=3)
+        finally:
+            connection.disconnect()
+
+        self.assertLess(time.monotonic() - start, 10)
+        self.assertEqual(len(self.server.imports), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
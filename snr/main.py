@@ -1,18 +1,123 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import math
 import os
-from typing import List, Tuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from io import BytesIO
+from typing import TYPE_CHECKING, Any, Dict, Iterable, List, Optional, Set, Tuple
+from xml.etree import ElementTree
+
+if TYPE_CHECKING:
+    import numpy as np
+    import pydicom
+
+
+# A DICOM Part 10 file starts with a 128-byte preamble followed by "DICM"
+DICOM_PREAMBLE_LENGTH = 128
+DICOM_MAGIC = b"DICM"
+# Number of bytes read from each file to parse the series tags
+DICOM_HEADER_READ_SIZE = 8192
+SERIES_TAGS = ["SeriesInstanceUID", "SeriesNumber", "SeriesDescription"]
+
+# XNAT catalogs list the MD5 digest of each file of a resource
+CATALOG_SUFFIX = "catalog.xml"
+CATALOG_ENTRY_TAG = "{http://nrg.wustl.edu/catalog}entry"
+
+# Values of the VERIFY_DIGESTS and ON_DIGEST_MISMATCH environment variables
+DIGEST_MISMATCH_ACTIONS = ("fail", "quarantine")
+BOOLEAN_VALUES = {
+    "1": True,
+    "true": True,
+    "yes": True,
+    "0": False,
+    "false": False,
+    "no": False,
+}
+
+# Metrics computed by the QC engine
+QC_METRICS = ("snr", "cnr", "histogram", "hu_percentiles", "slice_stats")
+# Metrics that are infinite when the background noise is zero
+INFINITE_QC_METRICS = ("snr", "cnr")
+# Range of the intensity histogram and of the HU percentile sketch
+HU_RANGE = (-1024.0, 3072.0)
+# Width of the bins of the HU percentile sketch
+HU_SKETCH_BIN_WIDTH = 1.0
+
+
+def is_dicom_file(path_file: str) -> bool:
+    """
+    Check whether a file is a DICOM file from its preamble and "DICM" magic.
 
-import numpy as np
-import pydicom
+    Parameters
+    ----------
+    path_file : str
+        Path to the file.
+
+    Returns
+    -------
+    bool
+        True if the file is a DICOM file, False otherwise.
+    """
+    try:
+        with open(path_file, "rb") as file:
+            header = file.read(DICOM_PREAMBLE_LENGTH + len(DICOM_MAGIC))
+    except OSError:
+        return False
+    return header[DICOM_PREAMBLE_LENGTH:] == DICOM_MAGIC
 
 
-def get_dicom_files(path_input_folder: str) -> List[str]:
+def _scan_folder(
+    path_folder: str, excluded_folders: Set[str]
+) -> Tuple[List[str], List[str]]:
+    """
+    List the files and the subfolders of a single folder.
+
+    Parameters
+    ----------
+    path_folder : str
+        Path to the folder.
+    excluded_folders : Set[str]
+        Real paths of the subfolders to skip.
+
+    Returns
+    -------
+    Tuple[List[str], List[str]]
+        File paths and subfolder paths.
+    """
+    files = []
+    subfolders = []
+    with os.scandir(path_folder) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if os.path.realpath(entry.path) not in excluded_folders:
+                    subfolders.append(entry.path)
+            elif entry.is_file():
+                files.append(os.path.normpath(entry.path))
+    return files, subfolders
+
+
+def get_dicom_files(
+    path_input_folder: str,
+    excluded_folders: Iterable[str] = (),
+    max_workers: Optional[int] = None,
+) -> List[str]:
     """
     Find all DICOM files in the given folder.
 
+    Folders are scanned and files are checked for the DICOM magic concurrently,
+    so that the latency of network-mounted folders overlaps. Files are
+    recognised by their content, not by their extension.
+
     Parameters
     ----------
     path_input_folder : str
         Path to the directory containing DICOM files.
+    excluded_folders : Iterable[str]
+        Subfolders to skip, e.g. an output folder inside the input folder.
+    max_workers : Optional[int]
+        Maximum number of threads. Defaults to the ThreadPoolExecutor default.
 
     Returns
     -------
@@ -22,91 +127,391 @@ def get_dicom_files(path_input_folder: str) -> List[str]:
     if not os.path.exists(path_input_folder):
         raise FileNotFoundError(f"Folder '{path_input_folder}' does not exist.")
 
-    dicom_files = [
-        os.path.normpath(os.path.join(root, file))
-        for root, _, files in os.walk(path_input_folder)
-        for file in files
-        if file.lower().endswith(".dcm")
-    ]
+    excluded_real_paths = {os.path.realpath(folder) for folder in excluded_folders}
+    candidate_files = []
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {
+            executor.submit(_scan_folder, path_input_folder, excluded_real_paths)
+        }
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, subfolders = future.result()
+                candidate_files.extend(files)
+                pending.update(
+                    executor.submit(_scan_folder, subfolder, excluded_real_paths)
+                    for subfolder in subfolders
+                )
+
+        candidate_files.sort()
+        dicom_files = [
+            path
+            for path, is_dicom in zip(
+                candidate_files, executor.map(is_dicom_file, candidate_files)
+            )
+            if is_dicom
+        ]
 
     if not dicom_files:
-        raise FileNotFoundError(
-            f"No DICOM files (.dcm) found in '{path_input_folder}'."
-        )
+        raise FileNotFoundError(f"No DICOM files found in '{path_input_folder}'.")
     return dicom_files
 
 
-def check_order_dicom(list_input_dicom: List[str]) -> List[str]:
+def read_dicom_header(path_file: str) -> pydicom.Dataset:
+    """
+    Read the series tags of a DICOM file from the first bytes of the file.
+
+    Parameters
+    ----------
+    path_file : str
+        Path to the DICOM file.
+
+    Returns
+    -------
+    pydicom.Dataset
+        Dataset containing only the series tags.
+    """
+    import pydicom
+
+    with open(path_file, "rb") as file:
+        header = file.read(DICOM_HEADER_READ_SIZE)
+
+    try:
+        ds = pydicom.dcmread(
+            BytesIO(header), stop_before_pixels=True, specific_tags=SERIES_TAGS
+        )
+    except Exception:
+        ds = None
+
+    # Header longer than the bytes read: parse the file up to the pixel data
+    if ds is None or "SeriesInstanceUID" not in ds:
+        ds = pydicom.dcmread(
+            path_file, stop_before_pixels=True, specific_tags=SERIES_TAGS
+        )
+    return ds
+
+
+def group_dicom_by_series(
+    list_input_dicom: List[str],
+    excluded_description_suffix: Optional[str] = None,
+    max_workers: Optional[int] = None,
+) -> Dict[str, List[str]]:
+    """
+    Group DICOM files by Series Instance UID.
+
+    Parameters
+    ----------
+    list_input_dicom : List[str]
+        List of DICOM file paths.
+    excluded_description_suffix : Optional[str]
+        Skip the series whose Series Description ends with this suffix.
+    max_workers : Optional[int]
+        Maximum number of threads. Defaults to the ThreadPoolExecutor default.
+
+    Returns
+    -------
+    Dict[str, List[str]]
+        DICOM file paths for each Series Instance UID.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        headers = list(executor.map(read_dicom_header, list_input_dicom))
+
+    dicom_series: Dict[str, List[str]] = {}
+    for path, ds in zip(list_input_dicom, headers):
+        series_instance_uid = getattr(ds, "SeriesInstanceUID", None)
+        if series_instance_uid is None:
+            raise ValueError(f"Missing SeriesInstanceUID in DICOM file {path}")
+
+        series_description = str(getattr(ds, "SeriesDescription", ""))
+        if excluded_description_suffix and series_description.upper().endswith(
+            excluded_description_suffix
+        ):
+            continue
+
+        dicom_series.setdefault(str(series_instance_uid), []).append(path)
+    return dicom_series
+
+
+def get_catalog_digests(list_input_dicom: List[str]) -> Dict[str, str]:
+    """
+    Read the MD5 digests listed in the XNAT catalogs next to the DICOM files.
+
+    Parameters
+    ----------
+    list_input_dicom : List[str]
+        List of DICOM file paths.
+
+    Returns
+    -------
+    Dict[str, str]
+        MD5 digest for each file path listed in a catalog.
+    """
+    catalog_digests = {}
+    for path_folder in sorted({os.path.dirname(path) for path in list_input_dicom}):
+        with os.scandir(path_folder or ".") as entries:
+            catalog_paths = [
+                entry.path
+                for entry in entries
+                if entry.is_file() and entry.name.endswith(CATALOG_SUFFIX)
+            ]
+
+        for catalog_path in catalog_paths:
+            try:
+                catalog = ElementTree.parse(catalog_path)
+            except (ElementTree.ParseError, OSError) as e:
+                print(f"Warning: ignoring unreadable catalog '{catalog_path}': {e}")
+                continue
+
+            for entry in catalog.iter(CATALOG_ENTRY_TAG):
+                uri = entry.get("URI")
+                digest = entry.get("digest")
+                if uri and digest:
+                    path = os.path.normpath(os.path.join(path_folder, uri))
+                    catalog_digests[path] = digest.lower()
+    return catalog_digests
+
+
+def _read_dicom_slice(
+    path_file: str, expected_digest: Optional[str]
+) -> Tuple[bool, Optional[Tuple[Any, Tuple[int, ...], Any]]]:
+    """
+    Read a DICOM file once, verifying its MD5 digest and parsing the same bytes.
+
+    Parameters
+    ----------
+    path_file : str
+        Path to the DICOM file.
+    expected_digest : Optional[str]
+        Expected MD5 digest. If None, the file is not verified.
+
+    Returns
+    -------
+    Tuple[bool, Optional[Tuple[Any, Tuple[int, ...], Any]]]
+        Whether the digest matches, and the Instance Number, shape and data
+        type of the slice (None if the digest does not match).
+    """
+    import numpy as np
+    import pydicom
+
+    with open(path_file, "rb") as file:
+        data = file.read()
+
+    if expected_digest is not None:
+        digest = hashlib.md5(data, usedforsecurity=False).hexdigest()
+        if digest != expected_digest:
+            return False, None
+
+    ds = pydicom.dcmread(BytesIO(data))
+
+    instance_number = getattr(ds, "InstanceNumber", None)
+    if instance_number is None:
+        raise ValueError(f"Missing InstanceNumber in DICOM file {path_file}")
+
+    if not isinstance(ds.pixel_array, np.ndarray):
+        raise TypeError(
+            f"Invalid image format. Expected a NumPy array. DICOM file {path_file}."
+        )
+
+    if len(ds.pixel_array.shape) != 2:
+        raise ValueError(f"DICOM file {path_file} is not a 2D slice.")
+
+    return True, (instance_number, ds.pixel_array.shape, ds.pixel_array.dtype)
+
+
+def check_order_dicom(
+    list_input_dicom: List[str],
+    catalog_digests: Optional[Dict[str, str]] = None,
+    on_digest_mismatch: str = "fail",
+    max_workers: Optional[int] = None,
+) -> List[str]:
     """
     Check that all DICOM images in the input folder have valid and unique Instance Number,
     slices are 2D and have the same dimensions, data type and valid images.
     Reorder the DICOM file paths based on the Instance Number.
 
+    Files are read in a thread pool. If catalog digests are given, each file is
+    hashed from the same bytes that are parsed, so the verification does not
+    add a read.
+
     Parameters
     ----------
     list_input_dicom : List[str]
         List of DICOM file paths.
+    catalog_digests : Optional[Dict[str, str]]
+        Expected MD5 digest for each file path. Files without a digest are not verified.
+    on_digest_mismatch : str
+        "fail" to raise an error on a digest mismatch, "quarantine" to leave the
+        corrupted slices out of the returned list.
+    max_workers : Optional[int]
+        Maximum number of threads. Defaults to the ThreadPoolExecutor default.
 
     Returns
     -------
     List[str]
         List of DICOM file paths sorted by Instance Number.
     """
+    if on_digest_mismatch not in DIGEST_MISMATCH_ACTIONS:
+        raise ValueError(
+            f"Invalid on_digest_mismatch '{on_digest_mismatch}'. "
+            "Expected 'fail' or 'quarantine'."
+        )
+    catalog_digests = catalog_digests or {}
+
     dicom_with_instances = []
     instance_numbers_set = set()
     reference_shape = None
     reference_dtype = None
 
-    for path in list_input_dicom:
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        slices = executor.map(
+            _read_dicom_slice,
+            list_input_dicom,
+            [catalog_digests.get(path) for path in list_input_dicom],
+        )
 
-        ds = pydicom.dcmread(path)
+        for path, (digest_ok, slice_info) in zip(list_input_dicom, slices):
 
-        instance_number = getattr(ds, "InstanceNumber", None)
-        if instance_number is None:
-            raise ValueError(f"Missing InstanceNumber in DICOM file {path}")
+            if not digest_ok:
+                if on_digest_mismatch == "fail":
+                    raise ValueError(f"MD5 digest mismatch in DICOM file {path}")
+                print(f"Quarantined DICOM file {path}: MD5 digest mismatch.")
+                continue
 
-        if instance_number in instance_numbers_set:
-            raise ValueError(
-                f"Duplicate Instance Number detected: {instance_number} in DICOM file {path}"
-            )
-        instance_numbers_set.add(instance_number)
+            instance_number, shape, dtype = slice_info
 
-        if not isinstance(ds.pixel_array, np.ndarray):
-            raise TypeError(
-                f"Invalid image format. Expected a NumPy array. DICOM file {path}."
-            )
+            if instance_number in instance_numbers_set:
+                raise ValueError(
+                    f"Duplicate Instance Number detected: {instance_number} in DICOM file {path}"
+                )
+            instance_numbers_set.add(instance_number)
 
-        if len(ds.pixel_array.shape) != 2:
-            raise ValueError(f"DICOM file {path} is not a 2D slice.")
+            if reference_shape is None:
+                reference_shape = shape
+            elif shape != reference_shape:
+                raise ValueError(
+                    f"Inconsistent slice dimensions detected in DICOM file {path}."
+                )
 
-        if reference_shape is None:
-            reference_shape = ds.pixel_array.shape
-        elif ds.pixel_array.shape != reference_shape:
-            raise ValueError(
-                f"Inconsistent slice dimensions detected in DICOM file {path}."
-            )
+            if reference_dtype is None:
+                reference_dtype = dtype
+            elif dtype != reference_dtype:
+                raise ValueError(
+                    f"Inconsistent slice data type detected in DICOM file {path}."
+                )
+            dicom_with_instances.append((instance_number, path))
 
-        if reference_dtype is None:
-            reference_dtype = ds.pixel_array.dtype
-        elif ds.pixel_array.dtype != reference_dtype:
-            raise ValueError(
-                f"Inconsistent slice data type detected in DICOM file {path}."
-            )
-        dicom_with_instances.append((instance_number, path))
+    if not dicom_with_instances:
+        raise ValueError("All DICOM files were quarantined.")
 
     # Sort files by Instance Number
     dicom_with_instances.sort(key=lambda x: x[0])
     return [path for _, path in dicom_with_instances]
 
 
-def calculate_snr(
+def _moments(values: np.ndarray) -> Tuple[int, float, float]:
+    """
+    Compute the count, mean and sum of squared deviations of an array.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        Array of values.
+
+    Returns
+    -------
+    Tuple[int, float, float]
+        Count, mean and sum of squared deviations from the mean.
+    """
+    mean = float(values.mean(dtype="float64"))
+    return values.size, mean, float(((values - mean) ** 2).sum())
+
+
+def _merge_moments(
+    moments_a: Tuple[int, float, float], moments_b: Tuple[int, float, float]
+) -> Tuple[int, float, float]:
+    """
+    Merge the moments of two samples (Chan et al. parallel algorithm).
+
+    Parameters
+    ----------
+    moments_a : Tuple[int, float, float]
+        Count, mean and sum of squared deviations of the first sample.
+    moments_b : Tuple[int, float, float]
+        Count, mean and sum of squared deviations of the second sample.
+
+    Returns
+    -------
+    Tuple[int, float, float]
+        Count, mean and sum of squared deviations of the merged sample.
+    """
+    count_a, mean_a, m2_a = moments_a
+    count_b, mean_b, m2_b = moments_b
+    count = count_a + count_b
+    if count == 0:
+        return moments_a
+
+    delta = mean_b - mean_a
+    mean = mean_a + delta * count_b / count
+    m2 = m2_a + m2_b + delta**2 * count_a * count_b / count
+    return count, mean, m2
+
+
+def _sketch_percentiles(
+    sketch_counts: np.ndarray, percentiles: Iterable[float]
+) -> Dict[str, float]:
+    """
+    Estimate percentiles from the counts of the HU sketch (nearest rank).
+
+    Parameters
+    ----------
+    sketch_counts : np.ndarray
+        Counts of the HU sketch bins.
+    percentiles : Iterable[float]
+        Percentiles to estimate, between 0 and 100.
+
+    Returns
+    -------
+    Dict[str, float]
+        HU value for each percentile, keyed as "p<percentile>".
+    """
+    import numpy as np
+
+    cumulative_counts = np.cumsum(sketch_counts)
+    total = int(cumulative_counts[-1])
+
+    hu_percentiles = {}
+    for percentile in percentiles:
+        rank = max(1, math.ceil(percentile / 100 * total))
+        index = int(np.searchsorted(cumulative_counts, rank))
+        hu_percentiles[f"p{percentile:g}"] = HU_RANGE[0] + index * HU_SKETCH_BIN_WIDTH
+    return hu_percentiles
+
+
+def calculate_qc_metrics(
     list_input_dicom_sorted: List[str],
     vol_dims: Tuple[int, int, int],
-    vol_dtype: np.dtype,
     kernel_size: int,
-) -> float:
+    metrics: Iterable[str] = QC_METRICS,
+    roi_contrast_start: Optional[Tuple[int, int]] = None,
+    histogram_bins: int = 64,
+    percentiles: Iterable[float] = (1, 5, 25, 50, 75, 95, 99),
+) -> Dict[str, Any]:
     """
-    Calculate the volume signal-to-noise ratio.
+    Calculate the QC metrics of the volume, reading each slice only once.
+
+    Every metric is accumulated slice by slice in mergeable form (moments,
+    histogram counts), so that adding a metric does not add a pass over the
+    files.
+
+    - snr: mean of the object ROI over the standard deviation of the
+      background ROI.
+    - cnr: absolute difference between the means of the object ROI and the
+      contrast ROI, over the standard deviation of the background ROI.
+    - histogram: intensity histogram in HU with fixed bins over HU_RANGE.
+    - hu_percentiles: HU percentiles estimated from a sketch with bins of
+      HU_SKETCH_BIN_WIDTH over HU_RANGE. Values outside the range are clamped.
+    - slice_stats: mean and standard deviation of each slice.
 
     Parameters
     ----------
@@ -114,41 +519,135 @@ def calculate_snr(
         List of DICOM file paths sorted by Instance Number.
     vol_dims : Tuple[int, int, int]
         Dimensions of the volume.
-    vol_dtype : np.dtype
-        Data type of the volume.
     kernel_size : int
-        Dimensions of the kernel.
+        Dimensions of the ROIs.
+    metrics : Iterable[str]
+        Metrics to calculate, among QC_METRICS.
+    roi_contrast_start : Optional[Tuple[int, int]]
+        Row and column of the top-left corner of the contrast ROI.
+        Defaults to the centre of the left half of the slice.
+    histogram_bins : int
+        Number of bins of the intensity histogram.
+    percentiles : Iterable[float]
+        Percentiles to estimate, between 0 and 100.
 
     Returns
     -------
-    float
-        SNR value.
+    Dict[str, Any]
+        Value of each metric.
     """
+    import numpy as np
+    import pydicom
+
+    metrics = set(metrics)
+    unknown_metrics = metrics.difference(QC_METRICS)
+    if unknown_metrics:
+        raise ValueError(f"Unknown QC metrics: {', '.join(sorted(unknown_metrics))}")
+
     # ROI parameters
-    roi_background = np.empty((vol_dims[0], kernel_size, kernel_size), dtype=vol_dtype)
-    roi_object = np.empty((vol_dims[0], kernel_size, kernel_size), dtype=vol_dtype)
     object_row_start = (vol_dims[1] - kernel_size) // 2
     object_col_start = (vol_dims[2] - kernel_size) // 2
+    if roi_contrast_start is None:
+        roi_contrast_start = (
+            object_row_start,
+            max(0, vol_dims[2] // 4 - kernel_size // 2),
+        )
+    contrast_row_start, contrast_col_start = roi_contrast_start
 
-    # Calculate the ROI of the background and object
-    for path_ind, path_elem in enumerate(list_input_dicom_sorted):
+    moments_background = moments_object = moments_contrast = (0, 0.0, 0.0)
+    histogram_counts = np.zeros(histogram_bins, dtype=np.int64)
+    num_sketch_bins = int(round((HU_RANGE[1] - HU_RANGE[0]) / HU_SKETCH_BIN_WIDTH))
+    sketch_counts = np.zeros(num_sketch_bins, dtype=np.int64)
+    slice_stats = []
+
+    for path_elem in list_input_dicom_sorted:
 
         ds = pydicom.dcmread(path_elem)
         image = ds.pixel_array
 
-        roi_background[path_ind, :, :] = image[:kernel_size, :kernel_size]
+        if metrics.intersection({"snr", "cnr"}):
+            moments_background = _merge_moments(
+                moments_background, _moments(image[:kernel_size, :kernel_size])
+            )
+            moments_object = _merge_moments(
+                moments_object,
+                _moments(
+                    image[
+                        object_row_start : object_row_start + kernel_size,
+                        object_col_start : object_col_start + kernel_size,
+                    ]
+                ),
+            )
 
-        roi_object[path_ind, :, :] = image[
-            object_row_start : object_row_start + kernel_size,
-            object_col_start : object_col_start + kernel_size,
-        ]
+        if "cnr" in metrics:
+            moments_contrast = _merge_moments(
+                moments_contrast,
+                _moments(
+                    image[
+                        contrast_row_start : contrast_row_start + kernel_size,
+                        contrast_col_start : contrast_col_start + kernel_size,
+                    ]
+                ),
+            )
 
-    std_background = roi_background.std()
-    return (
-        float("inf")
-        if std_background == 0
-        else round(roi_object.mean() / std_background, 2)
-    )
+        if metrics.intersection({"histogram", "hu_percentiles"}):
+            slope = float(getattr(ds, "RescaleSlope", 1))
+            intercept = float(getattr(ds, "RescaleIntercept", 0))
+            image_hu = image * slope + intercept
+
+        if "histogram" in metrics:
+            histogram_counts += np.histogram(
+                image_hu, bins=histogram_bins, range=HU_RANGE
+            )[0]
+
+        if "hu_percentiles" in metrics:
+            sketch_indices = np.floor((image_hu - HU_RANGE[0]) / HU_SKETCH_BIN_WIDTH)
+            sketch_indices = np.clip(sketch_indices, 0, num_sketch_bins - 1)
+            sketch_counts += np.bincount(
+                sketch_indices.astype(np.int64).ravel(), minlength=num_sketch_bins
+            )
+
+        if "slice_stats" in metrics:
+            count, mean, m2 = _moments(image)
+            slice_stats.append(
+                {
+                    "instance_number": int(ds.InstanceNumber),
+                    "mean": round(mean, 2),
+                    "std": round(math.sqrt(m2 / count), 2),
+                }
+            )
+
+    qc_metrics: Dict[str, Any] = {"num_slices": len(list_input_dicom_sorted)}
+    std_background = math.sqrt(moments_background[2] / max(moments_background[0], 1))
+
+    if "snr" in metrics:
+        qc_metrics["snr"] = (
+            float("inf")
+            if std_background == 0
+            else round(moments_object[1] / std_background, 2)
+        )
+
+    if "cnr" in metrics:
+        qc_metrics["cnr"] = (
+            float("inf")
+            if std_background == 0
+            else round(abs(moments_object[1] - moments_contrast[1]) / std_background, 2)
+        )
+
+    if "histogram" in metrics:
+        qc_metrics["histogram"] = {
+            "range": list(HU_RANGE),
+            "bins": histogram_bins,
+            "counts": histogram_counts.tolist(),
+        }
+
+    if "hu_percentiles" in metrics:
+        qc_metrics["hu_percentiles"] = _sketch_percentiles(sketch_counts, percentiles)
+
+    if "slice_stats" in metrics:
+        qc_metrics["slice_stats"] = slice_stats
+
+    return qc_metrics
 
 
 def save_snr_txt(
@@ -187,6 +686,104 @@ def save_snr_txt(
         file.write(string_to_write)
 
 
+def save_qc_json(
+    qc_metrics: Dict[str, Any],
+    path_output_folder: str,
+    series_number: str,
+) -> None:
+    """
+    Save the QC metrics in the output folder as a JSON file.
+
+    Parameters
+    ----------
+    qc_metrics : Dict[str, Any]
+        Value of each QC metric.
+    path_output_folder : str
+        Folder where to save the JSON file
+    series_number : str
+        Series number
+
+    """
+    if not os.path.exists(path_output_folder):
+        raise FileNotFoundError(f"Folder '{path_output_folder}' does not exist.")
+
+    output_path = os.path.join(path_output_folder, f"qc_scan_{series_number}.json")
+
+    # JSON has no infinity: an infinite SNR or CNR (zero background noise) is
+    # written as null, with a flag telling it apart from a missing value. The
+    # flag is always written, so that the schema does not depend on the data.
+    qc_json = {"series_number": series_number}
+    for metric, value in qc_metrics.items():
+        if metric in INFINITE_QC_METRICS:
+            qc_json[metric] = value if math.isfinite(value) else None
+            qc_json[f"{metric}_infinite"] = math.isinf(value)
+        else:
+            qc_json[metric] = value
+
+    with open(output_path, "w") as file:
+        json.dump(qc_json, file, indent=2, allow_nan=False)
+
+
+def get_digest_settings() -> Tuple[bool, str]:
+    """
+    Read the MD5 digest verification settings from the environment.
+
+    The VERIFY_DIGESTS variable (default "true") enables the verification, and
+    the ON_DIGEST_MISMATCH variable (default "fail") sets what to do with a
+    corrupted file: "fail" or "quarantine".
+
+    Returns
+    -------
+    Tuple[bool, str]
+        Whether to verify the digests, and the action on a digest mismatch.
+    """
+    verify_digests = os.environ.get("VERIFY_DIGESTS", "true").strip().lower()
+    if verify_digests not in BOOLEAN_VALUES:
+        raise ValueError(
+            f"Invalid VERIFY_DIGESTS '{verify_digests}'. "
+            f"Expected one of {sorted(BOOLEAN_VALUES)}."
+        )
+
+    on_digest_mismatch = os.environ.get("ON_DIGEST_MISMATCH", "fail").strip().lower()
+    if on_digest_mismatch not in DIGEST_MISMATCH_ACTIONS:
+        raise ValueError(
+            f"Invalid ON_DIGEST_MISMATCH '{on_digest_mismatch}'. "
+            "Expected 'fail' or 'quarantine'."
+        )
+
+    return BOOLEAN_VALUES[verify_digests], on_digest_mismatch
+
+
+def get_qc_metric_names() -> List[str]:
+    """
+    Read the QC metrics to calculate from the environment.
+
+    The QC_METRICS variable is a comma-separated list of metrics among
+    QC_METRICS (default: all of them). The SNR is always calculated, as it is
+    saved in the text file.
+
+    Returns
+    -------
+    List[str]
+        Names of the QC metrics to calculate.
+    """
+    qc_metrics = os.environ.get("QC_METRICS", "").strip().lower()
+    if not qc_metrics:
+        return list(QC_METRICS)
+
+    qc_metric_names = [name.strip() for name in qc_metrics.split(",") if name.strip()]
+    unknown_metrics = set(qc_metric_names).difference(QC_METRICS)
+    if unknown_metrics:
+        raise ValueError(
+            f"Invalid QC_METRICS '{', '.join(sorted(unknown_metrics))}'. "
+            f"Expected a comma-separated list of {', '.join(QC_METRICS)}."
+        )
+
+    if "snr" not in qc_metric_names:
+        qc_metric_names.insert(0, "snr")
+    return qc_metric_names
+
+
 def main():
     """
     Main function to process DICOM files and calculate SNR.
@@ -196,6 +793,9 @@ def main():
     kernel_size = 80
 
     try:
+        verify_digests, on_digest_mismatch = get_digest_settings()
+        qc_metric_names = get_qc_metric_names()
+
         # Get a list of dicom files contained in XNAT input folder
         list_input_dicom = get_dicom_files(path_input_folder)
         print(
@@ -203,28 +803,55 @@ def main():
             + "\n".join(f"'{file}'" for file in list_input_dicom)
         )
 
-        # Verify that the DICOM files in the XNAT input folder are valid
-        # and reorder them based on the Instance Number.
-        list_input_dicom_sorted = check_order_dicom(list_input_dicom)
-        print(
-            "DICOM files sorted by InstanceNumber:\n"
-            + "\n".join(f"'{file}'" for file in list_input_dicom_sorted)
+        # Import the image modules only once the input has been found
+        import pydicom
+
+        # Read the expected MD5 digests, checked while the files are read
+        catalog_digests = (
+            get_catalog_digests(list_input_dicom) if verify_digests else {}
         )
+        print(f"Found {len(catalog_digests)} catalog digests.")
+
+        # Group the DICOM files by series
+        dicom_series = group_dicom_by_series(list_input_dicom)
+        print(f"Found {len(dicom_series)} series in '{path_input_folder}'.")
+
+        for series_instance_uid, list_series_dicom in dicom_series.items():
 
-        # Calculate SNR
-        ref_ds = pydicom.dcmread(list_input_dicom_sorted[0])
-        num_rows, num_columns = ref_ds.pixel_array.shape
-        num_slices = len(list_input_dicom_sorted)
-        vol_dims = (num_slices, num_rows, num_columns)
-        vol_dtype = ref_ds.pixel_array.dtype
+            # Verify that the DICOM files in the XNAT input folder are intact
+            # and valid, and reorder them based on the Instance Number.
+            list_input_dicom_sorted = check_order_dicom(
+                list_series_dicom, catalog_digests, on_digest_mismatch
+            )
+            print(
+                "DICOM files sorted by InstanceNumber:\n"
+                + "\n".join(f"'{file}'" for file in list_input_dicom_sorted)
+            )
+
+            # Calculate SNR and the other QC metrics in a single pass
+            ref_ds = pydicom.dcmread(list_input_dicom_sorted[0])
+            num_rows, num_columns = ref_ds.pixel_array.shape
+            num_slices = len(list_input_dicom_sorted)
+            vol_dims = (num_slices, num_rows, num_columns)
 
-        snr = calculate_snr(list_input_dicom_sorted, vol_dims, vol_dtype, kernel_size)
-        print(f"SNR calculated successfully. SNR = {snr}")
+            qc_metrics = calculate_qc_metrics(
+                list_input_dicom_sorted, vol_dims, kernel_size, qc_metric_names
+            )
+            snr = qc_metrics["snr"]
+            print(f"SNR calculated successfully. SNR = {snr}")
+
+            # Save SNR in XNAT output folder, with one folder per series as
+            # the series number is often reused across series
+            path_series_output_folder = os.path.join(
+                path_output_folder, series_instance_uid
+            )
+            os.makedirs(path_series_output_folder, exist_ok=True)
 
-        # Save SNR in XNAT output folder
-        series_number = str(getattr(ref_ds, "SeriesNumber", "unknown"))
-        save_snr_txt(snr, path_output_folder, series_number, "txt")
-        print(f"SNR for scan {series_number} saved successfully.")
+            series_number = str(getattr(ref_ds, "SeriesNumber", "unknown"))
+            save_snr_txt(snr, path_series_output_folder, series_number, "txt")
+            print(f"SNR for scan {series_number} saved successfully.")
+            save_qc_json(qc_metrics, path_series_output_folder, series_number)
+            print(f"QC metrics for scan {series_number} saved successfully.")
 
     except Exception as e:
         print(f"Error: {e}")